@@ -1,56 +1,474 @@
 # `pip3 install assemblyai` (macOS)
 # `pip install assemblyai` (Windows)
 # pip install python-dotenv
+# pip install pyperclip
+# pip install tenacity
 
-from dotenv import load_dotenv
+# assemblyai, dotenv, pyperclip and tenacity are imported where they are used, they take long to import
+# and are not needed when the work is already cached or the script exits early
+import asyncio
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
-import assemblyai as aai
 from pathlib import Path
-from assemblyai import LanguageCode
+from types import SimpleNamespace
+
+__all__ = ["SpeechToText", "WebhookHandler", "quick_transcribe", "serve_webhooks"]
+
+CACHE_DIR = Path.home() / '.cache' / 'AssemblyAI'
+
+logger = logging.getLogger(__name__)
+
+_CONFIGURED = False
+
+
+def _ensure_configured():
+    # .env is parsed and the API key is set once per process, not for every transcription
+    global _CONFIGURED
+    if _CONFIGURED:
+        return
+    import assemblyai as aai
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = os.getenv("ASSEMBLYAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("API key not found in environment variables.")
+    aai.settings.api_key = api_key
+    _CONFIGURED = True
+
+
+@functools.lru_cache(maxsize=None)
+def _transcription_config(language_code, speaker_labels, webhook_url, webhook_auth_header_name,
+                          webhook_auth_header_value):
+    import assemblyai as aai
+    config = aai.TranscriptionConfig(language_code=language_code,
+                                     speaker_labels=speaker_labels)
+    if webhook_url:
+        config.set_webhook(webhook_url,
+                           auth_header_name=webhook_auth_header_name,
+                           auth_header_value=webhook_auth_header_value)
+    return config
+
+
+class _RateLimiter:
+    # token bucket: up to `rate` submissions per `period` seconds, refilled continuously
+    def __init__(self, rate, period):
+        self.rate = rate
+        self.period = period
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.period / self.rate)
+
+
+# AssemblyAI accepts 20 000 transcription requests per 5 minutes
+_submit_limiter = _RateLimiter(20000, 300)
+
+
+def _audio_fingerprint(path_to_file, config, single_speaker, chunk_sec=None, speedup=1.0):
+    # the same audio transcribed with other settings must not hit the cache
+    config_params = {key: value for key, value in config.raw.dict(exclude_none=True).items()
+                     if not key.startswith('webhook')}
+    with open(path_to_file, 'rb') as audio_file:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+, the file is hashed in OpenSSL without Python level chunk handling
+            digest = hashlib.file_digest(audio_file, 'sha256')
+        else:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: audio_file.read(1 << 20), b''):
+                digest.update(chunk)
+    digest.update(json.dumps(config_params, sort_keys=True, default=str).encode())
+    digest.update(b'sentences' if single_speaker else b'utterances')
+    digest.update(f'{chunk_sec}:{speedup}'.encode())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=128)
+def _load_cached(fingerprint):
+    # a miss raises FileNotFoundError, which lru_cache does not remember
+    items = json.loads((CACHE_DIR / f'{fingerprint}.json').read_bytes())
+    return tuple(SimpleNamespace(**item) for item in items)
+
+
+def _store_cached(fingerprint, transcriber_result):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    data = json.dumps([vars(item) for item in transcriber_result], ensure_ascii=False).encode('utf-8')
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_file.name, CACHE_DIR / f'{fingerprint}.json')
 
 
 class SpeechToText:
-    def __init__(self, path_to_file, single_speaker=True):
-        self.transcriber_result = None
+    # the first status check waits about a second per minute of audio, then the wait grows up to the maximum
+    polling_interval = 2
+    polling_backoff = 1.3
+    max_polling_interval = 30
+    # submitted webhook jobs are kept on disk, so the process handling the webhook can be a different one,
+    # None means AAI_JOBS_DB, which is read after .env is loaded
+    jobs_db = None
+    _TRANSCRIBER = None
+    _TRANSCRIBER_LOCK = threading.Lock()
+
+    def __init__(self, paths_to_files, single_speaker=True, chunk_sec=None, speedup=1.0, copy_clipboard=False,
+                 echo=True):
+        # a single path is still accepted and treated as a batch of one file
+        if isinstance(paths_to_files, (str, os.PathLike)):
+            paths_to_files = [paths_to_files]
+        self.transcriber_results = []
         self.config = None
-        self.path_to_file = path_to_file
-        self.file_name = Path(path_to_file).stem
+        self.paths_to_files = [str(path) for path in paths_to_files]
+        self.file_names = [Path(path).stem for path in self.paths_to_files]
+        # every file is saved as <stem>.txt, two files with the same stem would overwrite each other
+        duplicates = sorted({name for name in self.file_names if self.file_names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Files with the same name would be saved to the same .txt: {', '.join(duplicates)}")
         self.single_speaker = single_speaker
+        # long recordings can be split into chunks of chunk_sec seconds that are transcribed in parallel
+        self.chunk_sec = chunk_sec
+        # audio played faster is shorter, so it is billed and processed for less time,
+        # 1.0 to 2.0 is the range of ffmpeg's atempo in every version
+        if not 1.0 <= speedup <= 2.0:
+            raise ValueError(f"speedup must be between 1.0 and 2.0, got {speedup}")
+        self.speedup = speedup
+        self.copy_clipboard = copy_clipboard
+        # the saved transcript is also printed to the console
+        self.echo = echo
+
+    @classmethod
+    def configuration(cls, webhook=False):
+        from assemblyai import LanguageCode
+        _ensure_configured()
+        # only submit_job asks for the webhook, polled jobs must not call the webhook server
+        if not webhook:
+            return _transcription_config(LanguageCode.ru, True, None, None, None)
+        return _transcription_config(LanguageCode.ru, True, os.getenv("AAI_WEBHOOK_URL"),
+                                     os.getenv("AAI_WEBHOOK_AUTH_HEADER_NAME"),
+                                     os.getenv("AAI_WEBHOOK_AUTH_HEADER_VALUE"))
 
     @classmethod
-    def configuration(cls):
-        load_dotenv()
-        api_key = os.getenv("ASSEMBLYAI_API_KEY")
-        if not api_key:
-            raise RuntimeError("API key not found in environment variables.")
-        aai.settings.api_key = api_key
-        config = aai.TranscriptionConfig(language_code=LanguageCode.ru,
-                                         speaker_labels=True)
-        return config
-
-    def save_to_text_file(self):
-        with open(f'{self.file_name}.txt', 'w', encoding='utf-8') as text_file:
-            for sentence in self.transcriber_result:
-                if self.single_speaker:
-                    text_file.writelines(sentence.text + '\n')
-                    print(sentence.text)
-                else:
-                    text_file.writelines(f'Speaker {sentence.speaker} : {sentence.text}')
-                    print(f'Speaker {sentence.speaker} : {sentence.text}')
-
-    def sound_transcriber(self):
+    def transcriber(cls):
+        # one Transcriber for all files, so uploads and submissions reuse its pooled connections
+        # first called from several worker threads at once, the lock keeps it to a single instance
+        import assemblyai as aai
+        if cls._TRANSCRIBER is None:
+            with cls._TRANSCRIBER_LOCK:
+                if cls._TRANSCRIBER is None:
+                    cls._TRANSCRIBER = aai.Transcriber()
+        return cls._TRANSCRIBER
+
+    @classmethod
+    @contextlib.contextmanager
+    def jobs_connection(cls):
+        # autocommit, a job row must be visible to the webhook process as soon as it is written
+        _ensure_configured()
+        jobs_db = cls.jobs_db or os.getenv("AAI_JOBS_DB", "transcription_jobs.sqlite")
+        connection = sqlite3.connect(jobs_db, isolation_level=None)
+        try:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                               '(transcript_id TEXT PRIMARY KEY, path_to_file TEXT, single_speaker INTEGER, '
+                               'fingerprint TEXT, speedup REAL)')
+            yield connection
+        finally:
+            connection.close()
+
+    def save_to_text_file(self, file_name, transcriber_result):
+        if self.single_speaker:
+            lines = [f'{sentence.text}\n' for sentence in transcriber_result]
+        else:
+            lines = [f'Speaker {sentence.speaker} : {sentence.text}\n' for sentence in transcriber_result]
+        text = ''.join(lines)
+        # a string larger than the buffer goes straight to a single write() syscall
+        Path(f'{file_name}.txt').write_text(text, encoding='utf-8', newline='\n')
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def copy_to_clipboard(self):
+        import pyperclip
+        # the format is chosen once instead of being checked for every sentence
+        if self.single_speaker:
+            sentence_format = lambda sentence: sentence.text
+        else:
+            sentence_format = lambda sentence: f'Speaker {sentence.speaker} : {sentence.text}'
+        sentences = itertools.chain.from_iterable(self.transcriber_results)
+        pyperclip.copy(' '.join(map(sentence_format, sentences)))
+
+    @staticmethod
+    def _call_with_retry(func, *args, idempotent=True):
+        # transient API and network errors are retried with exponential backoff instead of failing the batch
+        import assemblyai as aai
+        import httpx
+        from tenacity import Retrying, before_sleep_log, retry_if_exception, stop_after_attempt, wait_exponential
+
+        def is_transient(exc):
+            if isinstance(exc, aai.types.TranscriptError):
+                status_code = getattr(exc, 'status_code', None)
+                return status_code is not None and (status_code == 429 or status_code >= 500)
+            if idempotent:
+                return isinstance(exc, httpx.TransportError)
+            # a request that may have reached the server is not sent again, it could create a second job
+            return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+
+        for attempt in Retrying(wait=wait_exponential(multiplier=1, min=1, max=60),
+                                stop=stop_after_attempt(6),
+                                retry=retry_if_exception(is_transient),
+                                before_sleep=before_sleep_log(logger, logging.WARNING),
+                                reraise=True):
+            with attempt:
+                return func(*args)
+
+    @classmethod
+    def _submit_with_retry(cls, path_to_file, config):
+        # uploaded on its own, so a failed submit is retried without sending the file again
+        audio_url = path_to_file
+        if os.path.isfile(path_to_file):
+            audio_url = cls._call_with_retry(cls.transcriber().upload_file, path_to_file)
+        return cls._call_with_retry(cls.transcriber().submit, audio_url, config, idempotent=False)
+
+    @staticmethod
+    def _audio_duration(path_to_file):
+        # ffprobe comes with ffmpeg, without it the duration is unknown and the default interval is used
+        if not os.path.isfile(path_to_file):
+            return None
+        try:
+            result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                     '-of', 'default=noprint_wrappers=1:nokey=1', path_to_file],
+                                    capture_output=True, text=True, check=True)
+            return float(result.stdout)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+
+    @classmethod
+    def _fetch_status(cls, transcript_id):
+        # a single GET, Transcript.get_by_id would block until the job is finished
+        import assemblyai as aai
+        return aai.api.get_transcript(aai.Client.get_default().http_client, transcript_id)
+
+    async def transcribe_async(self, path_to_file, config, duration=None):
+        import assemblyai as aai
+        # submit returns as soon as the job is queued, the status is polled without blocking the event loop
+        await _submit_limiter.acquire()
+        if duration is None:
+            duration = await asyncio.to_thread(self._audio_duration, path_to_file)
+        transcript = await asyncio.to_thread(self._submit_with_retry, path_to_file, config)
+        interval = self.polling_interval
+        if duration:
+            interval = min(max(self.polling_interval, duration / 60), self.max_polling_interval)
+        status = transcript
+        while status.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+            await asyncio.sleep(interval)
+            interval = min(interval * self.polling_backoff, self.max_polling_interval)
+            status = await asyncio.to_thread(self._call_with_retry, self._fetch_status, transcript.id)
+        if status.status == aai.TranscriptStatus.error:
+            raise RuntimeError(f"Transcription of {path_to_file} failed: {status.error}")
+        # the job is finished, so get_by_id returns after one request
+        return await asyncio.to_thread(self._call_with_retry, aai.Transcript.get_by_id, transcript.id)
+
+    def _preprocess(self, path_to_file, tmp_dir):
+        if self.speedup <= 1.0:
+            return path_to_file
+        output_path = f'{tmp_dir}/{Path(path_to_file).stem}.m4a'
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path_to_file,
+                        '-filter:a', f'atempo={self.speedup}', '-vn', output_path],
+                       check=True)
+        return output_path
+
+    def _split_audio(self, path_to_file, tmp_dir):
+        suffix = Path(path_to_file).suffix
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path_to_file, '-f', 'segment',
+                        '-segment_time', str(self.chunk_sec), '-reset_timestamps', '1', '-vn', '-c', 'copy',
+                        f'{tmp_dir}/chunk_%03d{suffix}'],
+                       check=True)
+        return sorted(Path(tmp_dir).glob(f'chunk_*{suffix}'))
+
+    async def chunked_transcribe_async(self, path_to_file, config):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            chunks = await asyncio.to_thread(self._split_audio, path_to_file, tmp_dir)
+            # with -c copy the cuts fall on packet boundaries, so the chunks are not exactly chunk_sec long
+            durations = await asyncio.gather(*[asyncio.to_thread(self._audio_duration, str(chunk))
+                                               for chunk in chunks])
+            # the chunk durations are known already, ffprobe is not run again for the polling interval
+            transcripts = await asyncio.gather(*[self.transcribe_async(str(chunk), config, duration or self.chunk_sec)
+                                                 for chunk, duration in zip(chunks, durations)])
+        # chunk timestamps start from zero, shift them to the position of the chunk in the whole recording
+        transcriber_result = ()
+        offset = 0
+        for transcript, duration in zip(transcripts, durations):
+            transcriber_result += await asyncio.to_thread(self.transcript_result, transcript, round(offset))
+            offset += (duration or self.chunk_sec) * 1000
+        return transcriber_result
+
+    async def cached_transcribe_async(self, path_to_file, config):
+        # only local files are cached, a URL is passed to AssemblyAI as it is
+        fingerprint = None
+        if os.path.isfile(path_to_file):
+            fingerprint = await asyncio.to_thread(_audio_fingerprint, path_to_file, config,
+                                                  self.single_speaker, self.chunk_sec, self.speedup)
+            try:
+                return _load_cached(fingerprint)
+            except FileNotFoundError:
+                pass
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            upload_path = await asyncio.to_thread(self._preprocess, path_to_file, tmp_dir)
+            if self.chunk_sec:
+                transcriber_result = await self.chunked_transcribe_async(upload_path, config)
+            else:
+                transcript = await self.transcribe_async(upload_path, config)
+                transcriber_result = await asyncio.to_thread(self.transcript_result, transcript)
+        if fingerprint is not None:
+            await asyncio.to_thread(_store_cached, fingerprint, transcriber_result)
+        return transcriber_result
+
+    async def sound_transcriber(self):
+        # a failed file must not cancel the others, their jobs are billed and their results still saved
         config = self.configuration()
-        transcript = aai.Transcriber().transcribe(self.path_to_file, config)
-        return transcript
+        return await asyncio.gather(*[self.cached_transcribe_async(path, config) for path in self.paths_to_files],
+                                    return_exceptions=True)
 
-    def speech_to_text(self):
+    def transcript_result(self, transcript, offset=0):
         if self.single_speaker:
-            self.transcriber_result = self.sound_transcriber().get_sentences()
+            # sentences are a separate request, utterances come with the transcript
+            items = self._call_with_retry(transcript.get_sentences)
         else:
-            self.transcriber_result = self.sound_transcriber().utterances
-        self.save_to_text_file()
+            items = transcript.utterances
+        # timestamps of sped up audio are scaled back to the original recording
+        return tuple(SimpleNamespace(text=item.text, speaker=item.speaker,
+                                     start=round((item.start + offset) * self.speedup),
+                                     end=round((item.end + offset) * self.speedup))
+                     for item in items)
+
+    def process_transcription(self, file_name, transcriber_result):
+        self.transcriber_results.append(transcriber_result)
+        self.save_to_text_file(file_name, transcriber_result)
+
+    async def speech_to_text_async(self):
+        transcriber_results = await self.sound_transcriber()
+        failures = []
+        for path, file_name, transcriber_result in zip(self.paths_to_files, self.file_names, transcriber_results):
+            if isinstance(transcriber_result, BaseException):
+                failures.append((path, transcriber_result))
+            else:
+                self.process_transcription(file_name, transcriber_result)
+        if self.copy_clipboard:
+            self.copy_to_clipboard()
+        if failures:
+            details = '; '.join(f'{path}: {error}' for path, error in failures)
+            raise RuntimeError(f"{len(failures)} of {len(self.paths_to_files)} files failed: {details}") \
+                from failures[0][1]
+
+    def speech_to_text(self):
+        asyncio.run(self.speech_to_text_async())
+
+    def submit_job(self):
+        # webhook flow: only queue the jobs, AssemblyAI calls AAI_WEBHOOK_URL when each one is done
+        config = self.configuration(webhook=True)
+        if not config.webhook_url:
+            raise RuntimeError("AAI_WEBHOOK_URL not found in environment variables.")
+        if self.chunk_sec:
+            raise RuntimeError("chunk_sec is not supported with webhooks, use speech_to_text() instead.")
+        transcript_ids = []
+        with self.jobs_connection() as connection, tempfile.TemporaryDirectory() as tmp_dir:
+            for path in self.paths_to_files:
+                # the fingerprint is taken here, the webhook process may not have the audio file
+                fingerprint = None
+                if os.path.isfile(path):
+                    fingerprint = _audio_fingerprint(path, config, self.single_speaker, speedup=self.speedup)
+                transcript = self._submit_with_retry(self._preprocess(path, tmp_dir), config)
+                connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                                   (transcript.id, path, int(self.single_speaker), fingerprint, self.speedup))
+                transcript_ids.append(transcript.id)
+        return transcript_ids
+
+    @classmethod
+    def handle_webhook(cls, transcript_id):
+        import assemblyai as aai
+        with cls.jobs_connection() as connection:
+            job = connection.execute('SELECT path_to_file, single_speaker, fingerprint, speedup FROM jobs '
+                                     'WHERE transcript_id = ?', (transcript_id,)).fetchone()
+        if job is None:
+            raise KeyError(f"Unknown transcript id: {transcript_id}")
+        path_to_file, single_speaker, fingerprint, speedup = job
+        speaker = cls(path_to_file, single_speaker=bool(single_speaker), speedup=speedup)
+        cls.configuration()
+        transcript = cls._call_with_retry(aai.Transcript.get_by_id, transcript_id)
+        if transcript.status == aai.TranscriptStatus.error:
+            # nothing to save and a retry would fail the same way, so the job is done
+            logger.error("Transcription of %s failed: %s", path_to_file, transcript.error)
+            with cls.jobs_connection() as connection:
+                connection.execute('DELETE FROM jobs WHERE transcript_id = ?', (transcript_id,))
+            return None
+        transcriber_result = speaker.transcript_result(transcript)
+        speaker.process_transcription(speaker.file_names[0], transcriber_result)
+        with cls.jobs_connection() as connection:
+            connection.execute('DELETE FROM jobs WHERE transcript_id = ?', (transcript_id,))
+        # the transcript is already saved, a cache failure must not lose it
+        if fingerprint is not None:
+            try:
+                _store_cached(fingerprint, transcriber_result)
+            except OSError:
+                logger.warning("Could not cache transcript %s", transcript_id, exc_info=True)
+        return speaker
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def respond(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        auth_header_name = os.getenv("AAI_WEBHOOK_AUTH_HEADER_NAME")
+        if auth_header_name and self.headers.get(auth_header_name) != os.getenv("AAI_WEBHOOK_AUTH_HEADER_VALUE"):
+            self.respond(401)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        # the transcript is saved before answering, any failure gets a non-2xx and AssemblyAI sends the webhook
+        # again, the job row is only deleted once the transcript is saved
+        if body.get('status') in ('completed', 'error'):
+            try:
+                SpeechToText.handle_webhook(body['transcript_id'])
+            except KeyError:
+                logger.warning("Webhook for an unknown transcript: %s", body)
+                self.respond(404)
+                return
+            except Exception:
+                logger.exception("Webhook for transcript %s failed", body.get('transcript_id'))
+                self.respond(500)
+                return
+        self.respond(200)
+
+
+def quick_transcribe(paths_to_files, single_speaker=True, **options):
+    speaker = SpeechToText(paths_to_files, single_speaker=single_speaker, **options)
+    speaker.speech_to_text()
+    return speaker.transcriber_results
+
+
+def serve_webhooks(port=8000):
+    _ensure_configured()
+    # one thread per request, a slow transcript fetch does not hold back the other webhooks
+    ThreadingHTTPServer(('', port), WebhookHandler).serve_forever()
 
 
 if __name__ == '__main__':
-    speaker = SpeechToText('/Volumes/big4photo/Downloads/IMG_9407.MOV')
+    speaker = SpeechToText(['/Volumes/big4photo/Downloads/IMG_9407.MOV'])
     speaker.speech_to_text()
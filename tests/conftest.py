@@ -0,0 +1,95 @@
+import itertools
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+aai = pytest.importorskip("assemblyai")
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+pytest.importorskip("tenacity")
+
+import speech_to_text  # noqa: E402
+
+
+class FakeAssemblyAI:
+    # the AssemblyAI REST API as seen by the SDK, served through httpx.MockTransport
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.polls_left = {}
+        self.failing = set()
+        self.submitted = []
+        self.status_requests = []
+
+    def submit(self, audio_url, polls=2):
+        transcript_id = f't{next(self.ids)}'
+        self.polls_left[transcript_id] = polls
+        self.submitted.append((transcript_id, audio_url))
+        return transcript_id
+
+    def status(self, transcript_id):
+        if self.polls_left[transcript_id] > 0:
+            return 'processing'
+        audio_url = dict(self.submitted)[transcript_id]
+        return 'error' if audio_url in self.failing else 'completed'
+
+    def __call__(self, request):
+        path = request.url.path
+        if request.method == 'POST' and path == '/v2/upload':
+            # upload URLs name the uploaded bytes, so tests can tell the files apart
+            return httpx.Response(200, json={'upload_url': f'https://cdn.test/{request.read().decode()}'})
+        if request.method == 'POST' and path == '/v2/transcript':
+            audio_url = json.loads(request.content)['audio_url']
+            return httpx.Response(200, json={'id': self.submit(audio_url), 'status': 'queued',
+                                             'audio_url': audio_url, 'language_code': 'ru'})
+        transcript_id = path.split('/')[3]
+        if transcript_id not in self.polls_left:
+            return httpx.Response(404, json={'error': 'not found'})
+        if path.endswith('/sentences'):
+            return httpx.Response(200, json={'id': transcript_id, 'confidence': 1.0, 'audio_duration': 2,
+                                             'sentences': [self.item(transcript_id, 0, 1000),
+                                                           self.item(transcript_id, 1000, 2000)]})
+        self.status_requests.append(transcript_id)
+        self.polls_left[transcript_id] -= 1
+        status = self.status(transcript_id)
+        return httpx.Response(200, json={'id': transcript_id, 'status': status, 'language_code': 'ru',
+                                         'audio_url': dict(self.submitted)[transcript_id],
+                                         'error': 'bad audio' if status == 'error' else None,
+                                         'utterances': [self.item(transcript_id, 0, 500, speaker='A')]})
+
+    def item(self, transcript_id, start, end, speaker=None):
+        audio_url = dict(self.submitted)[transcript_id]
+        return {'text': audio_url.rsplit('/', 1)[-1], 'start': start, 'end': end, 'confidence': 1.0,
+                'words': [], 'speaker': speaker}
+
+
+@pytest.fixture
+def fake_api(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('ASSEMBLYAI_API_KEY', 'test-key')
+    for name in ('AAI_WEBHOOK_URL', 'AAI_WEBHOOK_AUTH_HEADER_NAME', 'AAI_WEBHOOK_AUTH_HEADER_VALUE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(aai.settings, 'api_key', 'test-key')
+    monkeypatch.setattr(speech_to_text, '_CONFIGURED', False)
+    monkeypatch.setattr(speech_to_text, 'CACHE_DIR', tmp_path / 'cache')
+    monkeypatch.setattr(speech_to_text.SpeechToText, '_TRANSCRIBER', None)
+    monkeypatch.setattr(speech_to_text.SpeechToText, 'jobs_db', str(tmp_path / 'jobs.sqlite'))
+    monkeypatch.setattr(speech_to_text.SpeechToText, 'polling_interval', 0)
+    monkeypatch.setattr(speech_to_text.SpeechToText, 'max_polling_interval', 0)
+    monkeypatch.setattr(speech_to_text.SpeechToText, '_audio_duration', staticmethod(lambda path_to_file: None))
+    speech_to_text._load_cached.cache_clear()
+
+    api = FakeAssemblyAI()
+    client = aai.Client(settings=aai.settings)
+    client._http_client = httpx.Client(base_url=client.settings.base_url, transport=httpx.MockTransport(api))
+    monkeypatch.setattr(aai.Client, '_default', client)
+    return api
+
+
+@pytest.fixture
+def no_retry_wait(monkeypatch):
+    import tenacity
+    monkeypatch.setattr(tenacity.nap.time, 'sleep', lambda seconds: None)
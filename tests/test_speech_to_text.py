@@ -0,0 +1,153 @@
+import json
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import assemblyai as aai
+import httpx
+import pytest
+
+import speech_to_text
+from speech_to_text import SpeechToText, WebhookHandler
+
+
+def write_audio(name, content=None):
+    Path(name).write_bytes((content or Path(name).stem).encode())
+    return name
+
+
+def test_batch_is_saved_per_file_and_polled_until_completed(fake_api):
+    speaker = SpeechToText([write_audio('a.wav'), write_audio('b.wav')], echo=False)
+    speaker.speech_to_text()
+
+    assert Path('a.txt').read_text(encoding='utf-8') == 'a\na\n'
+    assert Path('b.txt').read_text(encoding='utf-8') == 'b\nb\n'
+    # queued -> processing -> completed: the status was really polled more than once per job
+    assert fake_api.status_requests.count('t1') >= 2
+
+
+def test_failed_file_does_not_drop_the_others(fake_api):
+    fake_api.failing.add('https://cdn.test/b')
+    speaker = SpeechToText([write_audio('a.wav'), write_audio('b.wav')], echo=False)
+
+    with pytest.raises(RuntimeError, match=r'1 of 2 files failed: b\.wav'):
+        speaker.speech_to_text()
+    assert Path('a.txt').exists()
+    assert not Path('b.txt').exists()
+
+
+def test_duplicate_output_names_are_rejected():
+    with pytest.raises(ValueError, match='rec'):
+        SpeechToText(['a/rec.mp3', 'b/rec.mp3'])
+
+
+@pytest.mark.parametrize('speedup', [0.8, 2.5])
+def test_speedup_outside_atempo_range_is_rejected(speedup):
+    with pytest.raises(ValueError):
+        SpeechToText('a.mp3', speedup=speedup)
+
+
+def test_chunk_offsets_follow_real_durations(fake_api, monkeypatch):
+    durations = {'chunk_000.wav': 299.5, 'chunk_001.wav': None, 'chunk_002.wav': 12.0}
+
+    def split_audio(self, path_to_file, tmp_dir):
+        return [Path(write_audio(f'{tmp_dir}/{name}', name)) for name in durations]
+
+    monkeypatch.setattr(SpeechToText, '_split_audio', split_audio)
+    monkeypatch.setattr(SpeechToText, '_audio_duration', staticmethod(lambda path: durations[Path(path).name]))
+    speaker = SpeechToText(write_audio('long.wav'), chunk_sec=300, echo=False)
+    speaker.speech_to_text()
+
+    starts = [sentence.start for sentence in speaker.transcriber_results[0]]
+    # the chunk without a duration counts as chunk_sec long
+    assert starts == [0, 1000, 299500, 300500, 599500, 600500]
+
+
+def test_cache_key_depends_on_options(tmp_path):
+    path = write_audio(str(tmp_path / 'a.wav'))
+    config = aai.TranscriptionConfig(language_code='ru', speaker_labels=True)
+    webhook_config = aai.TranscriptionConfig(language_code='ru', speaker_labels=True)
+    webhook_config.set_webhook('https://example.com/hook')
+
+    base = speech_to_text._audio_fingerprint(path, config, True)
+    assert speech_to_text._audio_fingerprint(path, webhook_config, True) == base
+    assert len({base,
+                speech_to_text._audio_fingerprint(path, config, False),
+                speech_to_text._audio_fingerprint(path, config, True, chunk_sec=300),
+                speech_to_text._audio_fingerprint(path, config, True, speedup=1.5)}) == 4
+
+
+def test_cached_result_skips_the_api(fake_api):
+    SpeechToText(write_audio('a.wav'), echo=False).speech_to_text()
+    speech_to_text._load_cached.cache_clear()
+    speaker = SpeechToText('a.wav', echo=False)
+    speaker.speech_to_text()
+
+    assert len(fake_api.submitted) == 1
+    assert speaker.transcriber_results[0][0].text == 'a'
+
+
+def failing(error, calls):
+    def func():
+        calls.append(1)
+        raise error
+    return func
+
+
+@pytest.mark.parametrize('status_code, attempts', [(400, 1), (401, 1), (429, 6), (503, 6)])
+def test_only_rate_limit_and_server_errors_are_retried(no_retry_wait, status_code, attempts):
+    calls = []
+    with pytest.raises(aai.types.TranscriptError):
+        SpeechToText._call_with_retry(failing(aai.types.TranscriptError('failed', status_code), calls))
+    assert len(calls) == attempts
+
+
+@pytest.mark.parametrize('error, attempts', [(httpx.ReadTimeout('timeout'), 1), (httpx.ConnectError('refused'), 6)])
+def test_submit_is_not_resent_after_it_may_have_arrived(no_retry_wait, error, attempts):
+    calls = []
+    with pytest.raises(type(error)):
+        SpeechToText._call_with_retry(failing(error, calls), idempotent=False)
+    assert len(calls) == attempts
+
+
+def post_webhook(port, payload):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/', data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def test_submit_job_and_webhook_round_trip(fake_api, monkeypatch, tmp_path):
+    monkeypatch.setenv('AAI_WEBHOOK_URL', 'https://example.com/hook')
+    transcript_ids = SpeechToText([write_audio('a.wav'), write_audio('b.wav')], echo=False).submit_job()
+    fake_api.failing.add('https://cdn.test/b')
+    for transcript_id in transcript_ids:
+        fake_api.polls_left[transcript_id] = 0
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        port = server.server_address[1]
+        assert post_webhook(port, {'transcript_id': transcript_ids[0], 'status': 'completed'}) == 200
+        assert post_webhook(port, {'transcript_id': transcript_ids[1], 'status': 'error'}) == 200
+        assert post_webhook(port, {'transcript_id': 'unknown', 'status': 'completed'}) == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert Path('a.txt').read_text(encoding='utf-8') == 'a\na\n'
+    assert not Path('b.txt').exists()
+    with sqlite3.connect(tmp_path / 'jobs.sqlite') as connection:
+        assert connection.execute('SELECT COUNT(*) FROM jobs').fetchone() == (0,)
+
+
+def test_polled_jobs_do_not_use_the_webhook(fake_api, monkeypatch):
+    monkeypatch.setenv('AAI_WEBHOOK_URL', 'https://example.com/hook')
+    assert SpeechToText.configuration().webhook_url is None
+    assert SpeechToText.configuration(webhook=True).webhook_url == 'https://example.com/hook'